@@ -1,9 +1,26 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from rapidfuzz import fuzz
+from rapidfuzz.process import cpdist
 from io import BytesIO
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import xlsxwriter
 import traceback
 
+# Prefer the Rust-backed calamine reader for xlsx files; openpyxl builds the whole workbook in Python
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
+
+# Filtered and joined frames are only read downstream, so let them share buffers with their
+# source instead of copying; pandas 3 always works this way and deprecates the option
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 st.set_page_config(page_title="Job Reconciliation", layout="wide")
 st.title("🌳 Job Reconciliation Tool")
 
@@ -54,191 +71,833 @@ DEFAULT_EXCLUDED_TPS = [
     "Debbie and Leah"
 ]
 
+# Result tables larger than this tuck their Excel download behind an "Excel format (slower)" expander
+LARGE_EXPORT_ROWS = 5000
+
+# Drill-down tables longer than this show a preview until "Show all" is ticked
+PREVIEW_ROWS = 500
+
+# MIME type for the Excel downloads
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Encoded downloads kept per export function, so past results' files don't pile up in memory
+EXPORT_CACHE_ENTRIES = 32
+
+# Parsed uploads kept per loader, and reconciliation results kept, so old files and runs don't pile up in memory
+UPLOAD_CACHE_ENTRIES = 8
+RECON_CACHE_ENTRIES = 16
+
+# Mismatch categories in display order: (results key, breakdown metric label, drill-down expander title, download button key)
+DRILL_DOWNS = [
+    ('missing_in_tm', "Missing in TM", "❌ Missing in TM", "dl_missing_tm"),
+    ('missing_in_xero', "Missing in Xero", "❌ Missing in Xero", "dl_missing_xero"),
+    ('tp_mismatch_tm', "TP Mismatch (Tracker vs TM)", "⚠️ TP Mismatch - Tracker vs TM", "dl_tp_tm"),
+    ('tp_mismatch_xero', "TP Mismatch (TM vs Xero)", "⚠️ TP Mismatch - TM vs Xero", "dl_tp_xero"),
+    ('no_quote_in_tm', "No Quote in TM (Cost=0)", "💰 No Quote in TM - Cost=0", "dl_no_quote"),
+    ('cost_mismatch', "Cost Mismatch (>1%)", "💸 Cost Mismatch >1%", "dl_cost"),
+]
+
+# Mismatch Type label written into the combined exports for each category
+MISMATCH_TYPES = {key: key.replace('_', ' ').title() for key, _, _, _ in DRILL_DOWNS}
+
+# Tracebacks shown in the app keep only the innermost frames, where the error actually happened
+TRACEBACK_FRAMES = 20
+
+# Common TP name suffixes and prefixes removed by normalize_tp_name
+TP_SUFFIXES = (
+    ' limited', ' ltd', ' ltd.', ' llp',
+    ' tree services', ' tree service', ' tree surgery', ' tree surgeons',
+    ' tree care', ' tree solutions', ' trees',
+    ' arboricultural', ' arboriculture', ' arborists',
+    ' services', ' consultancy', ' contractors',
+    ' (east midlands)', ' (midlands)', ' (south)', ' (north)',
+    ' uk', ' group'
+)
+TP_PREFIXES = ('dc ', 'tcr ')
+
+@lru_cache(maxsize=50_000)
 def normalize_tp_name(name):
-    """Normalize TP name by removing common suffixes and cleaning up"""
+    """Normalize TP name by removing common suffixes and cleaning up (cached, as the same names recur across pairs)"""
     if pd.isna(name):
         return ''
     
     name = str(name).lower().strip()
     
-    # Common suffixes to remove
-    suffixes = [
-        ' limited', ' ltd', ' ltd.', ' llp',
-        ' tree services', ' tree service', ' tree surgery', ' tree surgeons',
-        ' tree care', ' tree solutions', ' trees',
-        ' arboricultural', ' arboriculture', ' arborists',
-        ' services', ' consultancy', ' contractors',
-        ' (east midlands)', ' (midlands)', ' (south)', ' (north)',
-        ' uk', ' group'
-    ]
-    
-    for suffix in suffixes:
+    # Suffixes are checked once each, in order, so a stacked suffix only goes if it comes later in the list
+    for suffix in TP_SUFFIXES:
         if name.endswith(suffix):
             name = name[:-len(suffix)].strip()
     
     # Remove common prefixes that might differ
-    prefixes = ['dc ', 'tcr ']
-    for prefix in prefixes:
+    for prefix in TP_PREFIXES:
         if name.startswith(prefix):
             name = name[len(prefix):].strip()
     
     return name.strip()
 
-def fuzzy_match(name1, name2, threshold=80):
-    """Check if two names match using fuzzy matching with normalization"""
-    try:
-        if pd.isna(name1) or pd.isna(name2):
-            return False
-        
-        n1 = str(name1).lower().strip()
-        n2 = str(name2).lower().strip()
-        
-        if n1 == '' or n2 == '':
-            return False
-        
-        # Exact match after lowercasing
-        if n1 == n2:
-            return True
-        
-        # Normalize and compare
-        n1_norm = normalize_tp_name(name1)
-        n2_norm = normalize_tp_name(name2)
-        
-        # Exact match after normalization
-        if n1_norm == n2_norm and n1_norm != '':
-            return True
-        
-        # Substring check on normalized names - but only if both names are similar length
-        # This avoids "kw" matching "kw edge" or "watson" matching "watson & price"
-        if n1_norm and n2_norm:
-            shorter = n1_norm if len(n1_norm) <= len(n2_norm) else n2_norm
-            longer = n2_norm if len(n1_norm) <= len(n2_norm) else n1_norm
-            
-            # Only do substring matching if:
-            # 1. Shorter name is at least 2 words AND
-            # 2. Shorter name is at least 70% the length of longer name
-            word_count = len(shorter.split())
-            length_ratio = len(shorter) / len(longer) if len(longer) > 0 else 0
-            
-            if word_count >= 2 and length_ratio >= 0.7:
-                if shorter in longer:
-                    return True
-        
-        # Use token_set_ratio on ORIGINAL names (not normalized) for better accuracy
-        token_score = fuzz.token_set_ratio(n1, n2)
-        if token_score >= 90:  # Higher threshold
-            return True
-        
-        # Partial ratio - good when one is clearly a substring
-        partial_score = fuzz.partial_ratio(n1, n2)
-        if partial_score >= 95:
-            return True
-        
-        # Standard ratio as fallback
-        standard_score = fuzz.ratio(n1, n2)
-        if standard_score >= threshold:
-            return True
-        
-        return False
-    except Exception:
+def is_substring_match(n1_norm, n2_norm):
+    """Check if the shorter normalized name is contained in a longer one of similar length"""
+    # This avoids "kw" matching "kw edge" or "watson" matching "watson & price"
+    if not n1_norm or not n2_norm:
         return False
+    shorter, longer = (n1_norm, n2_norm) if len(n1_norm) <= len(n2_norm) else (n2_norm, n1_norm)
+    # Shorter name must be at least 2 words and at least 70% the length of the longer name
+    return len(shorter.split()) >= 2 and len(shorter) / len(longer) >= 0.7 and shorter in longer
 
-def cost_matches(cost1, cost2, tolerance=0.01):
-    """Check if two costs match within tolerance (1%)"""
-    try:
-        if pd.isna(cost1) or pd.isna(cost2):
-            return False
-        cost1 = float(cost1)
-        cost2 = float(cost2)
-        if cost1 == 0 and cost2 == 0:
-            return True
-        if cost1 == 0 or cost2 == 0:
-            return False
-        diff = abs(cost1 - cost2) / max(cost1, cost2)
-        return diff <= tolerance
-    except Exception:
-        return False
+def tp_keys(names):
+    """Lowercase and strip TP names for fuzzy_match_pairs, with '' for missing names"""
+    return names.astype(str).str.lower().str.strip().where(names.notna(), '')
+
+def fuzzy_match_pairs(keys1, keys2, threshold=80):
+    """Check which pairs of TP names fuzzy-match, over two aligned sequences of TP keys (see tp_keys).
+    
+    The rapidfuzz scorers run over whole columns via cpdist instead of once per pair from Python.
+    """
+    n1 = pd.Series(keys1, dtype=object).reset_index(drop=True)
+    n2 = pd.Series(keys2, dtype=object).reset_index(drop=True)
+    if n1.empty:
+        return np.zeros(0, dtype=bool)
+    
+    valid = (n1.notna() & n2.notna() & (n1 != '') & (n2 != '')).to_numpy()
+    
+    # Identical keys match outright, without going through the scorers at all
+    matches = valid & (n1 == n2).to_numpy()
+    pending = valid & ~matches
+    n_pending = int(pending.sum())
+    if not n_pending:
+        return matches
+    
+    # Only score each distinct pair once; a handful of TPs account for most rows.
+    # Factorize both sides into one shared vocabulary so a pair is two ints, and order them
+    # within the pair as every rule is symmetric.
+    codes, vocab = pd.factorize(np.concatenate([n1.to_numpy()[pending], n2.to_numpy()[pending]]))
+    codes1, codes2 = codes[:n_pending], codes[n_pending:]
+    pair_ids = np.minimum(codes1, codes2) * len(vocab) + np.maximum(codes1, codes2)
+    unique_ids, pair_codes = np.unique(pair_ids, return_inverse=True)
+    
+    first = vocab[unique_ids // len(vocab)].tolist()
+    second = vocab[unique_ids % len(vocab)].tolist()
+    matches[pending] = score_name_pairs(first, second, threshold)[pair_codes]
+    return matches
 
-def extract_tm_number(value):
-    """Extract TM number, handling various formats"""
+def score_name_pairs(n1, n2, threshold=80):
+    """Apply the TP name matching rules to aligned lists of lowercased, non-empty names.
+    
+    A pair matches if the names are equal after normalization or one contains the other (is_substring_match),
+    else on rapidfuzz scores of the names as given: token_set_ratio >= 90, partial_ratio >= 95 or ratio >= threshold.
+    """
+    if not n1:
+        return np.zeros(0, dtype=bool)
+    
+    # Byte-equal names match outright; later rules only look at the rows still undecided
+    matched = np.array([a == b for a, b in zip(n1, n2)], dtype=bool)
+    for i in np.flatnonzero(~matched):
+        a, b = normalize_tp_name(n1[i]), normalize_tp_name(n2[i])
+        matched[i] = (a == b and a != '') or is_substring_match(a, b)
+    
+    # Score the ORIGINAL names (not normalized) for better accuracy: token_set_ratio, then partial_ratio
+    # (spread over all cores)
+    for scorer, cutoff in ((fuzz.token_set_ratio, 90), (fuzz.partial_ratio, 95)):
+        pending = np.flatnonzero(~matched)
+        if not len(pending):
+            return matched
+        matched[pending] = cpdist([n1[i] for i in pending], [n2[i] for i in pending],
+                                  scorer=scorer, score_cutoff=cutoff, workers=-1) >= cutoff
+    
+    # ratio can't exceed 200 * shorter / (len1 + len2), so skip pairs whose lengths alone rule it out
+    len1 = np.fromiter(map(len, n1), dtype=np.int64, count=len(n1))
+    len2 = np.fromiter(map(len, n2), dtype=np.int64, count=len(n2))
+    pending = np.flatnonzero(~matched & (200 * np.minimum(len1, len2) >= threshold * (len1 + len2)))
+    if len(pending):
+        matched[pending] = cpdist([n1[i] for i in pending], [n2[i] for i in pending],
+                                  scorer=fuzz.ratio, score_cutoff=threshold, workers=-1) >= threshold
+    
+    return matched
+
+def parse_cost(value):
+    """Parse a cost that may contain commas or currency symbols"""
+    if pd.isna(value):
+        return 0.0
+    val = str(value).strip()
+    # Remove commas and currency symbols
+    val = val.replace(',', '').replace('£', '').replace('$', '').strip()
     try:
-        if pd.isna(value):
-            return None
-        val = str(value).strip()
-        if val == '' or val.lower() == 'nan':
-            return None
-        val = val.upper()
-        if val.startswith("TM"):
-            return val
-        else:
-            return f"TM{val}"
-    except Exception:
-        return None
+        return float(val)
+    except:
+        return 0.0
 
-def is_valid_tm_number(tm_no):
-    """Check if TM number is valid (not None, not empty)"""
-    if tm_no is None:
-        return False
-    if str(tm_no).strip() == '' or str(tm_no).strip().upper() == 'TM':
-        return False
-    return True
+def parse_costs(series):
+    """Parse a whole column of costs like parse_cost (0 for blanks or unparseable values)"""
+    # A column the CSV reader already parsed as numbers needs no per-value string cleanup
+    if pd.api.types.is_float_dtype(series.dtype) or pd.api.types.is_integer_dtype(series.dtype):
+        return series.astype(float).fillna(0.0)
+    return series.map(parse_cost).astype(float)
+
+def compare_costs(costs1, costs2, tolerance=0.01):
+    """Check which pairs of costs match within tolerance (1%), over two aligned cost columns.
+    
+    Both zero counts as a match; one zero or a missing cost does not.
+    Returns (match mask, absolute difference, difference as % of the larger cost).
+    """
+    costs1 = np.asarray(costs1, dtype=np.float64)
+    costs2 = np.asarray(costs2, dtype=np.float64)
+    zero1 = costs1 == 0
+    zero2 = costs2 == 0
+    
+    diff = np.subtract(costs1, costs2)
+    np.abs(diff, out=diff)
+    
+    # Work in place on one buffer: max cost -> ratio -> percentage
+    ratio = np.maximum(costs1, costs2)
+    positive = ratio > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.divide(diff, ratio, out=ratio)
+    matches = (zero1 & zero2) | (~zero1 & ~zero2 & (ratio <= tolerance))
+    
+    diff_pct = np.multiply(ratio, 100, out=ratio)
+    diff_pct[~positive] = 0.0
+    return matches, diff, diff_pct
+
+def extract_tm_numbers(series, strip_float_suffix=False):
+    """Extract TM numbers from a whole column, handling various formats (None for blanks).
+    
+    strip_float_suffix drops a trailing '.0' left over from float conversion (Xero invoice numbers).
+    """
+    values = series.astype(str).str.strip()
+    blank = (series.isna() | (values == '') | (values.str.lower() == 'nan')).to_numpy()
+    if strip_float_suffix:
+        values = values.str.replace(r'\.0$', '', regex=True)
+    values = values.str.upper()
+    tm_numbers = values.where(values.str.startswith('TM'), 'TM' + values).astype(object)
+    tm_numbers[blank] = None
+    return tm_numbers
+
+def valid_tm_numbers(tm_numbers):
+    """Check which TM numbers are valid (not None, not empty, not a bare 'TM')"""
+    values = tm_numbers.astype(str).str.strip().str.upper()
+    return tm_numbers.notna() & (values != '') & (values != 'TM')
+
+def parse_dates(series):
+    """Parse a column of dates: dd/mm/YYYY first, then any other format (NaT when unparseable)"""
+    dates = pd.to_datetime(series, format='%d/%m/%Y', errors='coerce')
+    retry = dates.isna() & series.notna()
+    if retry.any():
+        dates.loc[retry] = pd.to_datetime(series[retry], format='mixed', errors='coerce')
+    return dates
+
+def rows_to_excel(sheets):
+    """Stream DataFrame rows straight into xlsxwriter sheets and return the workbook bytes.
+    
+    sheets is a list of (sheet name, frames, columns), where frames is a list of (df, constants) pairs; each
+    row goes under its matching `columns` header, with `constants` (column -> value) repeated on every row
+    of that frame. Writing row by row is what lets xlsxwriter run in constant_memory mode, which pandas'
+    column-by-column ExcelWriter can't use.
+    
+    Errors are raised rather than shown: this runs inside the download buttons' callables, where Streamlit
+    ignores st.error, and a raised error also keeps st.cache_data from caching a failed export.
+    """
+    output = BytesIO()
+    # Text cells are written as plain strings: no per-cell URL or formula sniffing
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'strings_to_urls': False,
+                                            'strings_to_formulas': False})
+    # Same header and date styles as DataFrame.to_excel
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    datetime_format = workbook.add_format({'num_format': 'YYYY-MM-DD HH:MM:SS'})
+    date_format = workbook.add_format({'num_format': 'YYYY-MM-DD'})
+    
+    for sheet_name, frames, columns in sheets:
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, columns, header_format)
+        row = 1
+        for df, constants in frames:
+            positions = [columns.index(col) for col in [*df.columns, *constants]]
+            extra = tuple(constants.values())
+            # Numeric and datetime64 columns and the constant labels go straight to the matching typed
+            # writer, skipping worksheet.write's per-cell type dispatch; everything else is sniffed cell by cell
+            writers = []
+            for col in df.columns:
+                dtype = df[col].dtype
+                if pd.api.types.is_datetime64_any_dtype(dtype):
+                    writers.append((worksheet.write_datetime, datetime_format))
+                elif pd.api.types.is_float_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+                    writers.append((worksheet.write_number, None))
+                else:
+                    writers.append((None, None))
+            writers += [(worksheet.write_string, None) if isinstance(value, str) else (None, None) for value in extra]
+            # Leave blanks for missing values, like DataFrame.to_excel does
+            values_df = df.astype(object).where(df.notna(), None)
+            for values in values_df.itertuples(index=False, name=None):
+                for col, value, (writer, cell_format) in zip(positions, values + extra, writers):
+                    if value is None:
+                        continue
+                    if writer is not None:
+                        writer(row, col, value, cell_format)
+                    elif isinstance(value, datetime):
+                        worksheet.write_datetime(row, col, value, datetime_format)
+                    elif isinstance(value, date):
+                        worksheet.write_datetime(row, col, value, date_format)
+                    else:
+                        worksheet.write(row, col, value)
+                row += 1
+    
+    workbook.close()
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def to_excel(recon_key, name, _df):
+    """Convert dataframe to Excel bytes, cached so reruns don't re-encode unchanged results.
+    
+    Keyed on the reconciliation run (recon_key, as passed to run_reconciliation) and the table's name
+    rather than on the frame: Streamlit hashes large frames from a sample of rows, which could serve a
+    corrected re-upload the previous file's download.
+    """
+    return rows_to_excel([('Sheet1', [(_df, {})], list(_df.columns))])
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def mismatches_to_excel(recon_key, _results):
+    """Write every mismatch category into one workbook: an All Mismatches sheet tagged with each row's Mismatch Type, then a sheet per category.
+    
+    Categories are streamed one after another instead of building one combined DataFrame first,
+    so memory stays flat however many mismatches there are. Cached on the run like to_excel.
+    """
+    categories = [(key, df) for key, df in _results.items() if key != 'matched' and not df.empty]
+    frames = [(df, {'Mismatch Type': MISMATCH_TYPES[key]}) for key, df in categories]
+    columns = list(dict.fromkeys(col for df, constants in frames for col in [*df.columns, *constants]))
+    sheets = [('All Mismatches', frames, columns)]
+    sheets += [(MISMATCH_TYPES[key], [(df, {})], list(df.columns)) for key, df in categories]
+    return rows_to_excel(sheets)
 
-def parse_date(date_val):
-    """Parse date and extract month-year"""
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def combine_mismatches(recon_key, _results):
+    """Stack every mismatch category into one DataFrame tagged with its Mismatch Type (cached on the run like to_excel).
+    
+    The category frames are stacked as they are, then every row is tagged in one np.repeat. The tag is
+    categorical so each row holds a small code instead of its own string, and it sits after the first
+    category's columns.
+    """
+    mismatch_keys = [key for key, df in _results.items() if key != 'matched' and not df.empty]
+    if not mismatch_keys:
+        return pd.DataFrame()
+    
+    all_df = pd.concat([_results[key] for key in mismatch_keys], ignore_index=True)
+    codes = np.repeat(np.arange(len(mismatch_keys)), [len(_results[key]) for key in mismatch_keys])
+    labels = [MISMATCH_TYPES[key] for key in mismatch_keys]
+    all_df.insert(len(_results[mismatch_keys[0]].columns), 'Mismatch Type', pd.Categorical.from_codes(codes, categories=labels))
+    return all_df
+
+@st.cache_data(show_spinner=False, max_entries=EXPORT_CACHE_ENTRIES)
+def to_csv_bytes(recon_key, name, _df):
+    """Convert dataframe to UTF-8 CSV bytes, cached like to_excel"""
+    return _df.to_csv(index=False).encode('utf-8')
+
+def download_buttons(recon_key, df, file_stem, key, label="📥 Download", **button_kwargs):
+    """Show Excel and CSV download buttons for one of a reconciliation run's result frames.
+    
+    The files are only encoded when a button is clicked, not on every rerun. Over LARGE_EXPORT_ROWS,
+    CSV is the one shown up front as it encodes far faster, and Excel moves into an expander, like the
+    Export All Mismatches section.
+    """
+    def excel_button():
+        st.download_button(f"{label} (Excel)", lambda: to_excel(recon_key, file_stem, df), f"{file_stem}.xlsx", XLSX_MIME, key=key, **button_kwargs)
+    
+    if len(df) <= LARGE_EXPORT_ROWS:
+        excel_button()
+    st.download_button(f"{label} (CSV)", lambda: to_csv_bytes(recon_key, file_stem, df), f"{file_stem}.csv", "text/csv", key=f"{key}_csv", **button_kwargs)
+    if len(df) > LARGE_EXPORT_ROWS:
+        with st.expander("Excel format (slower)"):
+            excel_button()
+
+def clean_tp_name_for_xero(name):
+    """Remove DC/TCR prefixes and clean up TP name for Xero"""
+    if pd.isna(name) or not name:
+        return ''
+    name = str(name).strip()
+    # Remove common prefixes - order matters! Longest first
+    prefixes_to_remove = ['DC & TCR ', 'DC &TCR ', 'DC TCR ', 'TCR ', 'DC ']
+    for prefix in prefixes_to_remove:
+        if name.upper().startswith(prefix.upper()):
+            name = name[len(prefix):].strip()
+            break  # Only remove one prefix
+    return name
+
+def format_date_for_xero(date_val):
+    """Format date as dd/MM/YYYY for Xero"""
+    if pd.isna(date_val) or date_val == '':
+        return ''
     try:
-        if pd.isna(date_val):
-            return None
-        if isinstance(date_val, str):
-            if date_val.strip() == '':
-                return None
-            dt = pd.to_datetime(date_val, format='%d/%m/%Y', errors='coerce')
-            if pd.isna(dt):
-                dt = pd.to_datetime(date_val, errors='coerce')
+        if isinstance(date_val, datetime):
+            return date_val.strftime('%d/%m/%Y')
+        elif isinstance(date_val, str):
+            # Try to parse common formats
+            for fmt in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d']:
+                try:
+                    dt = datetime.strptime(date_val.split(' ')[0], fmt)
+                    return dt.strftime('%d/%m/%Y')
+                except:
+                    continue
+            return date_val  # Return as-is if can't parse
         else:
-            dt = pd.to_datetime(date_val, errors='coerce')
-        return dt
-    except Exception:
-        return None
+            return str(date_val)
+    except:
+        return ''
 
-def safe_strftime(dt, fmt='%b %Y', default='No Date'):
-    """Safely format datetime"""
+def calculate_due_date(invoice_date_str):
+    """Calculate due date as invoice date + 30 days"""
+    if not invoice_date_str:
+        return ''
     try:
-        if pd.isna(dt) or dt is None:
-            return default
-        return dt.strftime(fmt)
-    except Exception:
-        return default
+        dt = datetime.strptime(invoice_date_str, '%d/%m/%Y')
+        due_dt = dt + timedelta(days=30)
+        return due_dt.strftime('%d/%m/%Y')
+    except:
+        return ''
 
-def to_excel(df):
-    """Convert dataframe to Excel bytes"""
-    try:
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False)
-        return output.getvalue()
-    except Exception as e:
-        st.error(f"Error creating Excel file: {str(e)}")
-        return None
+def xero_bill_template(missing_xero):
+    """Build the Xero bill import template for the jobs missing in Xero"""
+    # Build the template column by column, then slot a blank row in after each entry
+    tp_names = missing_xero['TM TP'] if 'TM TP' in missing_xero else missing_xero['TP']
+    invoice_dates = missing_xero['FF Inspection Date'].map(format_date_for_xero)
+    entries = pd.DataFrame({
+        'ContactName': tp_names.map(clean_tp_name_for_xero),
+        # Remove TM prefix for Xero
+        'InvoiceNumber': missing_xero['TM NO'].str.replace('TM', '', regex=False),
+        'InvoiceDate': invoice_dates,
+        'DueDate': invoice_dates.map(calculate_due_date),
+        'Total': missing_xero['TM Cost'],
+        'Description': missing_xero['Full Address'],
+        'Quantity': 1,
+        'UnitAmount': missing_xero['TM Cost'],
+        'AccountCode': '5-0820',
+        'TaxType': '20% (VAT on Expenses)',
+        'TaxAmount': ''
+    })
+    blank_rows = pd.DataFrame('', index=entries.index, columns=entries.columns)
+    return pd.concat([entries, blank_rows]).sort_index(kind='stable')
 
-def find_column(df, candidates):
-    """Find a column in dataframe using case-insensitive matching, handling extra spaces"""
+@st.fragment
+def export_section(recon_key, results, total_mismatches):
+    """Show the Export All Mismatches section.
+    
+    The combined table is stacked and encoded only when one of its download buttons is clicked, so the
+    Prepare exports gate no longer saves any work; it is just the UI step that reveals the buttons. The
+    section runs as a fragment, so that click reruns just this section rather than the whole results page.
+    """
+    st.header("📥 Export All Mismatches")
+    if st.button("Prepare exports", key="prep_exports"):
+        st.session_state['exports_ready'] = True
+    
+    if st.session_state.get('exports_ready') and total_mismatches:
+        # Nothing is stacked or encoded until a button is clicked. CSV is the default
+        # as it encodes far faster; Excel sits in an expander, as for large per-category tables
+        st.download_button("📥 Download All Mismatches (CSV)", lambda: to_csv_bytes(recon_key, 'all_mismatches', combine_mismatches(recon_key, results)), "all_mismatches.csv", "text/csv", key="dl_all_csv", type="primary")
+        with st.expander("Excel format (slower)"):
+            st.download_button("📥 Download All Mismatches (Excel, plus a sheet per type)", lambda: mismatches_to_excel(recon_key, results), "all_mismatches.xlsx", XLSX_MIME, key="dl_all")
+
+def column_index(df):
+    """Map each column's stripped, lowercased name to the real column name, for find_column"""
     try:
-        # Create mapping with stripped and lowercased column names
-        col_map = {c.lower().strip(): c for c in df.columns}
-        for candidate in candidates:
-            if candidate.lower().strip() in col_map:
-                return col_map[candidate.lower().strip()]
-        return None
+        return {c.lower().strip(): c for c in df.columns}
     except Exception:
-        return None
+        return {}
+
+def find_column(col_map, candidates):
+    """Find a column using case-insensitive matching, handling extra spaces (col_map from column_index)"""
+    for candidate in candidates:
+        key = candidate.lower().strip()
+        if key in col_map:
+            return col_map[key]
+    return None
 
 def safe_get_unique(series):
     """Safely get unique values from a series"""
     try:
-        return sorted([str(x) for x in series.dropna().unique() if str(x).strip() != ''])
+        # A categorical already holds its distinct values, so just drop the ones no longer in use
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.remove_unused_categories().cat.categories
+        else:
+            values = series.dropna().unique()
+        return sorted([str(x) for x in values if str(x).strip() != ''])
     except Exception:
         return []
 
+def optional_column(df, col):
+    """Get a column's values, or blanks if the column was not found"""
+    return df[col] if col else ''
+
+def summarize_by_tm_no(df):
+    """Count rows and list the distinct TP names for each TM number"""
+    # Group the names as plain objects: with a categorical _TP_NAME, pandas casts the joined lists back to
+    # categorical whenever each job has a single TP, and reindexing in missing jobs then fails on fillna('')
+    tp_names = df['_TP_NAME'].astype(object).groupby(df['_TM_NO'], sort=False)
+    return pd.DataFrame({
+        'rows': tp_names.size(),
+        'tps': tp_names.agg(lambda names: ', '.join(names.dropna().astype(str).unique().tolist()))
+    })
+
+def match_by_tm_no(left, right, columns, suffix, key_col='_TP_KEY'):
+    """Join each left row to the first right row with the same TM number whose TP name fuzzy-matches.
+    
+    The left TP is read from `key_col`, compared against the right frame's _TP_KEY.
+    Adds the matched row's _TP_NAME, _TP_KEY and `columns` with `suffix` appended (NaN when nothing matched),
+    plus _ROWS<suffix> (right rows sharing the TM number) and _TPS<suffix> (their TP names).
+    """
+    right = right.reset_index(drop=True)
+    
+    # A later row repeating an earlier row's job number and TP key can never be the first match,
+    # so only the first of each (job, TP) line item is a candidate
+    candidates = right.loc[~right.duplicated(['_TM_NO', '_TP_KEY']), ['_TM_NO', '_TP_NAME', '_TP_KEY'] + columns]
+    
+    # Hash join on the job number instead of scanning the right frame once per left row
+    pairs = pd.DataFrame({
+        '_LEFT': np.arange(len(left)),
+        '_TM_NO': left['_TM_NO'].to_numpy(),
+        '_TP': left[key_col].to_numpy()
+    }).merge(candidates.rename_axis('_RIGHT').reset_index(), on='_TM_NO')
+    pairs = pairs.sort_values(['_LEFT', '_RIGHT'])
+    
+    tp_ok = fuzzy_match_pairs(pairs['_TP'], pairs['_TP_KEY'])
+    first_match = pairs[tp_ok].drop_duplicates('_LEFT').set_index('_LEFT')
+    matched = first_match[['_TP_NAME', '_TP_KEY'] + columns].reindex(np.arange(len(left)))
+    
+    # One probe of the per-job summary's hash index serves both the row counts and the TP lists
+    summary = summarize_by_tm_no(right).reindex(left['_TM_NO'].to_numpy())
+    
+    # assign shares the left frame's columns under copy-on-write instead of duplicating them
+    new_cols = {col + suffix: matched[col].to_numpy() for col in matched.columns}
+    new_cols['_ROWS' + suffix] = summary['rows'].fillna(0).astype(int).to_numpy()
+    new_cols['_TPS' + suffix] = summary['tps'].fillna('').to_numpy()
+    return left.assign(**new_cols)
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def load_tracker(file_id, _file_bytes):
+    """Read the job tracker sheet, cached per upload.
+    
+    The cache is keyed on the upload's file_id; the leading underscore keeps Streamlit from
+    re-hashing the whole file on every rerun. Returns (tracker_df, sheet name, whether row 2 was used as the header row).
+    """
+    # Detect the right sheet
+    xlsx = pd.ExcelFile(BytesIO(_file_bytes), engine=EXCEL_ENGINE)
+    sheet_names = xlsx.sheet_names
+    
+    # Try to find the main tracker sheet
+    tracker_sheet = None
+    for name in ['Master Tracker', 'Sheet1', 'Tracker', 'Jobs']:
+        if name in sheet_names:
+            tracker_sheet = name
+            break
+    
+    if tracker_sheet is None:
+        tracker_sheet = sheet_names[0]  # Default to first sheet
+    
+    # Check if first row is a section header row (common pattern in formatted Excel files)
+    # If first column is something like "GENERAL JOB INFORMATION", the real headers are in row 2.
+    # Peek at the header alone so the full sheet is only parsed once, with the right header row
+    header_cols = pd.read_excel(xlsx, sheet_name=tracker_sheet, nrows=0).columns
+    first_col = str(header_cols[0]).strip().upper()
+    header_on_row_2 = 'GENERAL' in first_col or 'INFORMATION' in first_col or first_col.startswith('UNNAMED')
+    tracker_df = pd.read_excel(xlsx, sheet_name=tracker_sheet, header=1 if header_on_row_2 else 0)
+    
+    # Remove completely empty columns (Unnamed columns that are all NaN)
+    cols_to_drop = [col for col in tracker_df.columns if str(col).startswith('Unnamed') or pd.isna(col)]
+    if cols_to_drop:
+        tracker_df = tracker_df.drop(columns=cols_to_drop, errors='ignore')
+    
+    return tracker_df, tracker_sheet, header_on_row_2
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def prepare_tracker(file_id, _file_bytes, tm_no_col, tp_name_col, ff_date_col, po_type_col, status_col, client_col):
+    """Derive the matching columns for the tracker and drop rows without a TM number.
+    
+    Returns (tracker_df, number of rows dropped).
+    """
+    tracker_df, _, _ = load_tracker(file_id, _file_bytes)
+    tracker_df['_TM_NO'] = extract_tm_numbers(tracker_df[tm_no_col])
+    # A few TPs cover most jobs, so store names as categories: the exclude-TP isin and per-job grouping work on codes
+    tracker_df['_TP_NAME'] = tracker_df[tp_name_col].astype('category')
+    tracker_df['_TP_KEY'] = tp_keys(tracker_df['_TP_NAME'])
+    
+    if ff_date_col:
+        tracker_df['_FF_DATE'] = parse_dates(tracker_df[ff_date_col])
+        tracker_df['_MONTH'] = tracker_df['_FF_DATE'].dt.strftime('%b %Y').fillna('No Date')
+    else:
+        tracker_df['_MONTH'] = 'No Date'
+    
+    # Categorical string copies of the filter columns, so changing a filter doesn't re-cast them on every
+    # rerun and isin compares a handful of category codes instead of every row's string
+    tracker_df['_MONTH'] = tracker_df['_MONTH'].astype('category')
+    for col, filter_col in [(po_type_col, '_PO_TYPE'), (status_col, '_STATUS'), (client_col, '_CLIENT')]:
+        if col:
+            tracker_df[filter_col] = tracker_df[col].astype(str).astype('category')
+    
+    # Filter out blank TM numbers, keeping only the columns the filters and result tables read
+    valid_tm_mask = valid_tm_numbers(tracker_df['_TM_NO'])
+    keep_cols = ['_TM_NO', '_TP_NAME', '_TP_KEY', '_MONTH'] + [
+        filter_col for col, filter_col in [(po_type_col, '_PO_TYPE'), (status_col, '_STATUS'), (client_col, '_CLIENT')] if col
+    ] + [col for col in dict.fromkeys([ff_date_col, po_type_col, status_col, client_col]) if col]
+    return tracker_df.loc[valid_tm_mask, keep_cols], int((~valid_tm_mask).sum())
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def tracker_filter_options(file_id, _file_bytes, tm_no_col, tp_name_col, ff_date_col, po_type_col, status_col, client_col):
+    """Sorted sidebar filter choices for the prepared tracker, cached so reruns skip the column scans"""
+    tracker_df, _ = prepare_tracker(file_id, _file_bytes, tm_no_col, tp_name_col, ff_date_col, po_type_col, status_col, client_col)
+    
+    months = safe_get_unique(tracker_df['_MONTH'])
+    if 'No Date' not in months:
+        months.append('No Date')
+    
+    return {
+        'months': months,
+        'po_types': safe_get_unique(tracker_df[po_type_col]) if po_type_col else [],
+        'statuses': safe_get_unique(tracker_df[status_col]) if status_col else [],
+        'clients': safe_get_unique(tracker_df[client_col]) if client_col else [],
+        'tps': safe_get_unique(tracker_df['_TP_NAME'])
+    }
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def load_tm_report(file_id, _file_bytes):
+    """Read the TM report, cached per upload (keyed on file_id, like load_tracker)"""
+    return pd.read_excel(BytesIO(_file_bytes), engine=EXCEL_ENGINE)
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def prepare_tm_report(file_id, _file_bytes, job_col, tp_col, cost_col, address_col):
+    """Derive the matching columns for the TM report and drop rows without a valid TM number"""
+    tm_df = load_tm_report(file_id, _file_bytes)
+    tm_df['_TM_NO'] = extract_tm_numbers(tm_df[job_col])
+    tm_df['_TP_NAME'] = tm_df[tp_col].astype('category')
+    tm_df['_TP_KEY'] = tp_keys(tm_df['_TP_NAME'])
+    tm_df['_COST'] = pd.to_numeric(tm_df[cost_col], errors='coerce').fillna(0)
+    tm_df['_ADDRESS'] = tm_df[address_col] if address_col else ''
+    
+    # Filter out invalid TM numbers; reconciliation only reads the derived columns
+    valid_mask = valid_tm_numbers(tm_df['_TM_NO'])
+    return tm_df.loc[valid_mask, ['_TM_NO', '_TP_NAME', '_TP_KEY', '_COST', '_ADDRESS']]
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def load_xero_report(file_id, _file_bytes):
+    """Read the Xero report without its blank rows, cached per upload (keyed on file_id, like load_tracker)"""
+    try:
+        xero_df = pd.read_csv(BytesIO(_file_bytes), engine='pyarrow')
+    except (ImportError, ValueError):
+        # pyarrow missing or unable to parse this file - use the default parser
+        xero_df = pd.read_csv(BytesIO(_file_bytes))
+    
+    # Remove completely blank rows
+    return xero_df.dropna(how='all').reset_index(drop=True)
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_ENTRIES)
+def prepare_xero_report(file_id, _file_bytes, inv_col, contact_col, total_col):
+    """Derive the matching columns for the Xero report and drop rows without a valid TM number"""
+    xero_df = load_xero_report(file_id, _file_bytes)
+    
+    # Handle InvoiceNumber - may or may not have TM prefix
+    xero_df['_TM_NO'] = extract_tm_numbers(xero_df[inv_col], strip_float_suffix=True)
+    xero_df['_TP_NAME'] = xero_df[contact_col]
+    xero_df['_TP_KEY'] = tp_keys(xero_df['_TP_NAME'])
+    
+    # Handle Total - may have commas
+    xero_df['_COST'] = parse_costs(xero_df[total_col])
+    
+    # Filter out invalid TM numbers; reconciliation only reads the derived columns
+    valid_mask = valid_tm_numbers(xero_df['_TM_NO'])
+    return xero_df.loc[valid_mask, ['_TM_NO', '_TP_NAME', '_TP_KEY', '_COST']]
+
+@st.cache_data(show_spinner=False, max_entries=RECON_CACHE_ENTRIES)
+def run_reconciliation(match_mode, upload_ids, filters, _filtered_tracker, _tm_df, _xero_df, excluded_tps,
+                       ff_date_col, po_type_col, status_col, client_col):
+    """Reconcile the filtered tracker against the TM and/or Xero reports for the chosen mode.
+    
+    Cached on the uploads' file_ids and the filter selections the frames were derived from, rather than
+    on the frames themselves, so reruns (e.g. from download buttons) re-serve the same result frames
+    without hashing any data.
+    """
+    results = {
+        'matched': pd.DataFrame(),
+        'missing_in_tm': pd.DataFrame(),
+        'missing_in_xero': pd.DataFrame(),
+        'tp_mismatch_tm': pd.DataFrame(),
+        'tp_mismatch_xero': pd.DataFrame(),
+        'no_quote_in_tm': pd.DataFrame(),
+        'cost_mismatch': pd.DataFrame()
+    }
+    
+    if match_mode == "Tracker vs TM":
+        # Join each tracker row to the first TM row with the same job number and a matching TP
+        joined = match_by_tm_no(_filtered_tracker, _tm_df, ['_COST'], '_tm')
+        tm_found = joined['_ROWS_tm'] > 0
+        tp_ok = joined['_TP_NAME_tm'].notna()
+        no_quote = tp_ok & ((joined['_COST_tm'] == 0) | joined['_COST_tm'].isna())
+        
+        missing = joined[~tm_found]
+        results['missing_in_tm'] = pd.DataFrame({
+            'TM NO': missing['_TM_NO'],
+            'Tracker TP': missing['_TP_NAME'],
+            'Client': optional_column(missing, client_col),
+            'PO Type': optional_column(missing, po_type_col),
+            'Status': optional_column(missing, status_col),
+            'FF Date': optional_column(missing, ff_date_col)
+        }).reset_index(drop=True)
+        
+        # No TP match found among TM rows - list all TM TPs for reference
+        tp_mismatch = joined[tm_found & ~tp_ok]
+        results['tp_mismatch_tm'] = pd.DataFrame({
+            'TM NO': tp_mismatch['_TM_NO'],
+            'Tracker TP': tp_mismatch['_TP_NAME'],
+            'TM TP(s)': tp_mismatch['_TPS_tm'],
+            'TM Rows Found': tp_mismatch['_ROWS_tm'],
+            'Client': optional_column(tp_mismatch, client_col),
+            'Status': optional_column(tp_mismatch, status_col)
+        }).reset_index(drop=True)
+        
+        unquoted = joined[no_quote]
+        results['no_quote_in_tm'] = pd.DataFrame({
+            'TM NO': unquoted['_TM_NO'],
+            'Tracker TP': unquoted['_TP_NAME'],
+            'TM TP': unquoted['_TP_NAME_tm'],
+            'TM Cost': unquoted['_COST_tm'],
+            'Client': optional_column(unquoted, client_col),
+            'Status': optional_column(unquoted, status_col),
+            'FF Inspection Date': optional_column(unquoted, ff_date_col)
+        }).reset_index(drop=True)
+        
+        matched = joined[tp_ok & ~no_quote]
+        results['matched'] = pd.DataFrame({
+            'TM NO': matched['_TM_NO'],
+            'TP': matched['_TP_NAME'],
+            'TM Cost': matched['_COST_tm']
+        }).reset_index(drop=True)
+    
+    elif match_mode == "TM vs Xero":
+        # Filter TM by excluded TPs
+        filtered_tm = _tm_df[~_tm_df['_TP_NAME'].isin(excluded_tps)] if excluded_tps else _tm_df
+        
+        # Process unique TM NO + TP combinations
+        filtered_tm = filtered_tm[~filtered_tm.duplicated(['_TM_NO', '_TP_KEY'])]
+        
+        # Join each TM row to the first Xero row with the same job number and a matching TP
+        joined = match_by_tm_no(filtered_tm, _xero_df, ['_COST'], '_xero')
+        xero_found = joined['_ROWS_xero'] > 0
+        tp_ok = joined['_TP_NAME_xero'].notna()
+        
+        missing = joined[~xero_found]
+        # Look up FF Inspection Date from tracker if available
+        ff_dates = ''
+        if ff_date_col:
+            tracker_dates = _filtered_tracker.drop_duplicates('_TM_NO').set_index('_TM_NO')[ff_date_col]
+            ff_dates = missing['_TM_NO'].map(tracker_dates).where(missing['_TM_NO'].isin(tracker_dates.index), '')
+        results['missing_in_xero'] = pd.DataFrame({
+            'TM NO': missing['_TM_NO'],
+            'TM TP': missing['_TP_NAME'],
+            'TM Cost': missing['_COST'],
+            'Full Address': missing['_ADDRESS'],
+            'FF Inspection Date': ff_dates
+        }).reset_index(drop=True)
+        
+        tp_mismatch = joined[xero_found & ~tp_ok]
+        results['tp_mismatch_xero'] = pd.DataFrame({
+            'TM NO': tp_mismatch['_TM_NO'],
+            'TM TP': tp_mismatch['_TP_NAME'],
+            'Xero TP(s)': tp_mismatch['_TPS_xero'],
+            'TM Cost': tp_mismatch['_COST'],
+            'Xero Rows Found': tp_mismatch['_ROWS_xero']
+        }).reset_index(drop=True)
+        
+        paired = joined[tp_ok]
+        cost_ok, diff, diff_pct = compare_costs(paired['_COST'], paired['_COST_xero'])
+        mismatched = paired[~cost_ok]
+        results['cost_mismatch'] = pd.DataFrame({
+            'TM NO': mismatched['_TM_NO'],
+            'TP': mismatched['_TP_NAME'],
+            'TM Cost': mismatched['_COST'],
+            'Xero Total': mismatched['_COST_xero'],
+            'Difference': diff[~cost_ok],
+            'Diff %': [f"{pct:.1f}%" for pct in diff_pct[~cost_ok]]
+        }).reset_index(drop=True)
+        
+        matched = paired[cost_ok]
+        results['matched'] = pd.DataFrame({
+            'TM NO': matched['_TM_NO'],
+            'TP': matched['_TP_NAME'],
+            'Cost': matched['_COST']
+        }).reset_index(drop=True)
+    
+    elif match_mode == "3-way Full":
+        # Join each tracker row to the first TM row with the same job number and a matching TP
+        joined = match_by_tm_no(_filtered_tracker, _tm_df, ['_COST', '_ADDRESS'], '_tm')
+        tm_found = joined['_ROWS_tm'] > 0
+        tp_ok = joined['_TP_NAME_tm'].notna()
+        no_quote = tp_ok & ((joined['_COST_tm'] == 0) | joined['_COST_tm'].isna())
+        
+        missing = joined[~tm_found]
+        results['missing_in_tm'] = pd.DataFrame({
+            'TM NO': missing['_TM_NO'],
+            'Tracker TP': missing['_TP_NAME'],
+            'Client': optional_column(missing, client_col),
+            'Status': optional_column(missing, status_col)
+        }).reset_index(drop=True)
+        
+        tp_mismatch = joined[tm_found & ~tp_ok]
+        results['tp_mismatch_tm'] = pd.DataFrame({
+            'TM NO': tp_mismatch['_TM_NO'],
+            'Tracker TP': tp_mismatch['_TP_NAME'],
+            'TM TP(s)': tp_mismatch['_TPS_tm'],
+            'TM Rows Found': tp_mismatch['_ROWS_tm'],
+            'Client': optional_column(tp_mismatch, client_col)
+        }).reset_index(drop=True)
+        
+        unquoted = joined[no_quote]
+        results['no_quote_in_tm'] = pd.DataFrame({
+            'TM NO': unquoted['_TM_NO'],
+            'Tracker TP': unquoted['_TP_NAME'],
+            'TM TP': unquoted['_TP_NAME_tm'],
+            'Client': optional_column(unquoted, client_col),
+            'FF Inspection Date': optional_column(unquoted, ff_date_col)
+        }).reset_index(drop=True)
+        
+        # Find in Xero - also match by TP name, using the matched TM row's TP
+        joined = match_by_tm_no(joined[tp_ok & ~no_quote], _xero_df, ['_COST'], '_xero', key_col='_TP_KEY_tm')
+        xero_found = joined['_ROWS_xero'] > 0
+        xero_tp_ok = joined['_TP_NAME_xero'].notna()
+        
+        missing = joined[~xero_found]
+        results['missing_in_xero'] = pd.DataFrame({
+            'TM NO': missing['_TM_NO'],
+            'TP': missing['_TP_NAME'],
+            'TM Cost': missing['_COST_tm'],
+            'Full Address': missing['_ADDRESS_tm'],
+            'Client': optional_column(missing, client_col),
+            'FF Inspection Date': optional_column(missing, ff_date_col)
+        }).reset_index(drop=True)
+        
+        tp_mismatch = joined[xero_found & ~xero_tp_ok]
+        results['tp_mismatch_xero'] = pd.DataFrame({
+            'TM NO': tp_mismatch['_TM_NO'],
+            'TM TP': tp_mismatch['_TP_NAME_tm'],
+            'Xero TP(s)': tp_mismatch['_TPS_xero'],
+            'TM Cost': tp_mismatch['_COST_tm'],
+            'Xero Rows Found': tp_mismatch['_ROWS_xero']
+        }).reset_index(drop=True)
+        
+        paired = joined[xero_tp_ok]
+        cost_ok, diff, diff_pct = compare_costs(paired['_COST_tm'], paired['_COST_xero'])
+        mismatched = paired[~cost_ok]
+        results['cost_mismatch'] = pd.DataFrame({
+            'TM NO': mismatched['_TM_NO'],
+            'TP': mismatched['_TP_NAME'],
+            'TM Cost': mismatched['_COST_tm'],
+            'Xero Total': mismatched['_COST_xero'],
+            'Difference': diff[~cost_ok],
+            'Diff %': [f"{pct:.1f}%" for pct in diff_pct[~cost_ok]]
+        }).reset_index(drop=True)
+        
+        matched = paired[cost_ok]
+        results['matched'] = pd.DataFrame({
+            'TM NO': matched['_TM_NO'],
+            'TP': matched['_TP_NAME'],
+            'Cost': matched['_COST_tm']
+        }).reset_index(drop=True)
+    
+    return results
+
 # File uploaders
 st.sidebar.header("📁 Upload Files")
 tracker_file = st.sidebar.file_uploader("Job Tracker (.xlsx)", type=['xlsx'])
@@ -248,48 +907,26 @@ xero_file = st.sidebar.file_uploader("Xero Report (.csv)", type=['csv'])
 # Main logic
 if tracker_file:
     try:
-        # Load tracker data - detect the right sheet
-        xlsx = pd.ExcelFile(tracker_file)
-        sheet_names = xlsx.sheet_names
-        
-        # Try to find the main tracker sheet
-        tracker_sheet = None
-        for name in ['Master Tracker', 'Sheet1', 'Tracker', 'Jobs']:
-            if name in sheet_names:
-                tracker_sheet = name
-                break
-        
-        if tracker_sheet is None:
-            tracker_sheet = sheet_names[0]  # Default to first sheet
-        
-        tracker_df = pd.read_excel(xlsx, sheet_name=tracker_sheet)
+        # Load tracker data
+        tracker_bytes = tracker_file.getvalue()
+        tracker_df, tracker_sheet, header_on_row_2 = load_tracker(tracker_file.file_id, tracker_bytes)
         st.info(f"📋 Using sheet: '{tracker_sheet}'")
-        
-        # Check if first row is a section header row (common pattern in formatted Excel files)
-        # If first column is something like "GENERAL JOB INFORMATION", the real headers are in row 2
-        first_col = str(tracker_df.columns[0]).strip().upper()
-        if 'GENERAL' in first_col or 'INFORMATION' in first_col or first_col.startswith('UNNAMED'):
-            # Re-read with header on row 1 (0-indexed)
-            tracker_df = pd.read_excel(xlsx, sheet_name=tracker_sheet, header=1)
+        if header_on_row_2:
             st.info("📋 Detected header row format - using row 2 as column names")
         
-        # Remove completely empty columns (Unnamed columns that are all NaN)
-        cols_to_drop = [col for col in tracker_df.columns if str(col).startswith('Unnamed') or pd.isna(col)]
-        if cols_to_drop:
-            tracker_df = tracker_df.drop(columns=cols_to_drop, errors='ignore')
-        
         # Show tracker columns for debugging
         with st.expander("🔍 Tracker Columns (for debugging)"):
             st.write(list(tracker_df.columns))
             st.write(tracker_df.head())
         
         # Find required columns in tracker
-        tm_no_col = find_column(tracker_df, ['REPORT TM NO.', 'REPORT TM NO', 'TM NO', 'TM NO.', 'TMNO'])
-        tp_name_col = find_column(tracker_df, ['REPORT TP/DC NAME (IF APPLICABLE)', 'REPORT TP/DC NAME', 'TP NAME', 'TP/DC NAME'])
-        ff_date_col = find_column(tracker_df, ['FF INSPECTION DATE', 'FF DATE', 'INSPECTION DATE'])
-        po_type_col = find_column(tracker_df, ['PO TYPE', 'PO_TYPE', 'POTYPE'])
-        status_col = find_column(tracker_df, ['STATUS'])
-        client_col = find_column(tracker_df, ['CLIENT NAME', 'CLIENT_NAME', 'CLIENTNAME', 'CLIENT'])
+        tracker_cols = column_index(tracker_df)
+        tm_no_col = find_column(tracker_cols, ['REPORT TM NO.', 'REPORT TM NO', 'TM NO', 'TM NO.', 'TMNO'])
+        tp_name_col = find_column(tracker_cols, ['REPORT TP/DC NAME (IF APPLICABLE)', 'REPORT TP/DC NAME', 'TP NAME', 'TP/DC NAME'])
+        ff_date_col = find_column(tracker_cols, ['FF INSPECTION DATE', 'FF DATE', 'INSPECTION DATE'])
+        po_type_col = find_column(tracker_cols, ['PO TYPE', 'PO_TYPE', 'POTYPE'])
+        status_col = find_column(tracker_cols, ['STATUS'])
+        client_col = find_column(tracker_cols, ['CLIENT NAME', 'CLIENT_NAME', 'CLIENTNAME', 'CLIENT'])
         
         # Validate required columns
         missing_cols = []
@@ -304,19 +941,9 @@ if tracker_file:
             st.stop()
         
         # Process tracker data
-        tracker_df['_TM_NO'] = tracker_df[tm_no_col].apply(extract_tm_number)
-        tracker_df['_TP_NAME'] = tracker_df[tp_name_col]
-        
-        if ff_date_col:
-            tracker_df['_FF_DATE'] = tracker_df[ff_date_col].apply(parse_date)
-            tracker_df['_MONTH'] = tracker_df['_FF_DATE'].apply(lambda x: safe_strftime(x))
-        else:
-            tracker_df['_MONTH'] = 'No Date'
-        
-        # Filter out blank TM numbers
-        valid_tm_mask = tracker_df['_TM_NO'].apply(is_valid_tm_number)
-        blank_tm_count = (~valid_tm_mask).sum()
-        tracker_df = tracker_df[valid_tm_mask].copy()
+        tracker_df, blank_tm_count = prepare_tracker(
+            tracker_file.file_id, tracker_bytes, tm_no_col, tp_name_col, ff_date_col, po_type_col, status_col, client_col
+        )
         
         if blank_tm_count > 0:
             st.warning(f"⚠️ Ignored {blank_tm_count} rows with blank REPORT TM NO.")
@@ -324,14 +951,14 @@ if tracker_file:
         st.success(f"✅ Tracker loaded: {len(tracker_df)} jobs with valid TM numbers")
         
         # Get unique values for filters
-        all_months = safe_get_unique(tracker_df['_MONTH'])
-        if 'No Date' not in all_months:
-            all_months.append('No Date')
-        
-        all_po_types = safe_get_unique(tracker_df[po_type_col]) if po_type_col else []
-        all_statuses = safe_get_unique(tracker_df[status_col]) if status_col else []
-        all_clients = safe_get_unique(tracker_df[client_col]) if client_col else []
-        all_tracker_tps = safe_get_unique(tracker_df['_TP_NAME'])
+        filter_options = tracker_filter_options(
+            tracker_file.file_id, tracker_bytes, tm_no_col, tp_name_col, ff_date_col, po_type_col, status_col, client_col
+        )
+        all_months = filter_options['months']
+        all_po_types = filter_options['po_types']
+        all_statuses = filter_options['statuses']
+        all_clients = filter_options['clients']
+        all_tracker_tps = filter_options['tps']
         
         # Sidebar controls
         st.sidebar.header("🔧 Matching Mode")
@@ -357,24 +984,26 @@ if tracker_file:
         
         # Apply filters to tracker
         try:
-            filter_mask = tracker_df['_MONTH'].isin(selected_months)
+            predicates = [tracker_df['_MONTH'].isin(selected_months).to_numpy()]
             
             if po_type_col and selected_po_types:
-                filter_mask &= tracker_df[po_type_col].astype(str).isin(selected_po_types)
+                predicates.append(tracker_df['_PO_TYPE'].isin(selected_po_types).to_numpy())
             
             if status_col and selected_statuses:
-                filter_mask &= tracker_df[status_col].astype(str).isin(selected_statuses)
+                predicates.append(tracker_df['_STATUS'].isin(selected_statuses).to_numpy())
             
             if client_col and selected_clients:
-                filter_mask &= tracker_df[client_col].astype(str).isin(selected_clients)
+                predicates.append(tracker_df['_CLIENT'].isin(selected_clients).to_numpy())
             
             if excluded_tps:
-                filter_mask &= ~tracker_df['_TP_NAME'].isin(excluded_tps)
+                predicates.append(~tracker_df['_TP_NAME'].isin(excluded_tps).to_numpy())
             
-            filtered_tracker = tracker_df[filter_mask].copy()
+            # AND every predicate together in one pass over plain bool arrays
+            filter_mask = np.logical_and.reduce(predicates)
+            filtered_tracker = tracker_df[filter_mask]
         except Exception as e:
             st.error(f"Error applying filters: {str(e)}")
-            filtered_tracker = tracker_df.copy()
+            filtered_tracker = tracker_df
         
         st.info(f"📊 Filtered tracker: {len(filtered_tracker)} jobs (from {len(tracker_df)} total)")
         
@@ -382,26 +1011,21 @@ if tracker_file:
         tm_df = None
         if tm_file:
             try:
-                tm_df = pd.read_excel(tm_file)
+                tm_bytes = tm_file.getvalue()
+                tm_df = load_tm_report(tm_file.file_id, tm_bytes)
                 
                 with st.expander("🔍 TM Report Columns (for debugging)"):
                     st.write(list(tm_df.columns))
                     st.write(tm_df.head())
                 
-                job_col = find_column(tm_df, ['jobno', 'job no', 'job_no', 'jobnumber', 'job number', 'job'])
-                tp_col = find_column(tm_df, ['treeprofessional', 'tree professional', 'tpname', 'tp name', 'tp_name', 'contractor'])
-                cost_col = find_column(tm_df, ['tpcost', 'tp cost', 'tp_cost', 'cost', 'amount', 'total'])
-                address_col = find_column(tm_df, ['fulladdress', 'full address', 'address', 'site address', 'siteaddress', 'job address'])
+                tm_cols = column_index(tm_df)
+                job_col = find_column(tm_cols, ['jobno', 'job no', 'job_no', 'jobnumber', 'job number', 'job'])
+                tp_col = find_column(tm_cols, ['treeprofessional', 'tree professional', 'tpname', 'tp name', 'tp_name', 'contractor'])
+                cost_col = find_column(tm_cols, ['tpcost', 'tp cost', 'tp_cost', 'cost', 'amount', 'total'])
+                address_col = find_column(tm_cols, ['fulladdress', 'full address', 'address', 'site address', 'siteaddress', 'job address'])
                 
                 if job_col and tp_col and cost_col:
-                    tm_df['_TM_NO'] = tm_df[job_col].apply(extract_tm_number)
-                    tm_df['_TP_NAME'] = tm_df[tp_col]
-                    tm_df['_COST'] = pd.to_numeric(tm_df[cost_col], errors='coerce').fillna(0)
-                    tm_df['_ADDRESS'] = tm_df[address_col] if address_col else ''
-                    
-                    # Filter out invalid TM numbers
-                    valid_mask = tm_df['_TM_NO'].apply(is_valid_tm_number)
-                    tm_df = tm_df[valid_mask].copy()
+                    tm_df = prepare_tm_report(tm_file.file_id, tm_bytes, job_col, tp_col, cost_col, address_col)
                     
                     addr_msg = f", Address={address_col}" if address_col else " (no address column found)"
                     st.success(f"✅ TM Report mapped: Job={job_col}, TP={tp_col}, Cost={cost_col}{addr_msg} ({len(tm_df)} rows)")
@@ -418,57 +1042,20 @@ if tracker_file:
         xero_df = None
         if xero_file:
             try:
-                xero_df = pd.read_csv(xero_file)
-                
-                # Remove completely blank rows
-                xero_df = xero_df.dropna(how='all').reset_index(drop=True)
+                xero_bytes = xero_file.getvalue()
+                xero_df = load_xero_report(xero_file.file_id, xero_bytes)
                 
                 with st.expander("🔍 Xero Report Columns (for debugging)"):
                     st.write(list(xero_df.columns))
                     st.write(xero_df.head())
                 
-                inv_col = find_column(xero_df, ['invoicenumber', 'invoice number', 'invoice_number', 'invoice no', 'invno'])
-                contact_col = find_column(xero_df, ['contactname', 'contact name', 'contact_name', 'name', 'supplier'])
-                total_col = find_column(xero_df, ['total', 'amount', 'invoicetotal', 'invoice total'])
+                xero_cols = column_index(xero_df)
+                inv_col = find_column(xero_cols, ['invoicenumber', 'invoice number', 'invoice_number', 'invoice no', 'invno'])
+                contact_col = find_column(xero_cols, ['contactname', 'contact name', 'contact_name', 'name', 'supplier'])
+                total_col = find_column(xero_cols, ['total', 'amount', 'invoicetotal', 'invoice total'])
                 
                 if inv_col and contact_col and total_col:
-                    # Handle InvoiceNumber - may or may not have TM prefix
-                    def extract_xero_tm_number(value):
-                        if pd.isna(value):
-                            return None
-                        val = str(value).strip()
-                        if val == '' or val.lower() == 'nan':
-                            return None
-                        # Remove any .0 from float conversion
-                        if val.endswith('.0'):
-                            val = val[:-2]
-                        val = val.upper()
-                        # Add TM prefix if not present
-                        if val.startswith("TM"):
-                            return val
-                        else:
-                            return f"TM{val}"
-                    
-                    xero_df['_TM_NO'] = xero_df[inv_col].apply(extract_xero_tm_number)
-                    xero_df['_TP_NAME'] = xero_df[contact_col]
-                    
-                    # Handle Total - may have commas
-                    def parse_cost(value):
-                        if pd.isna(value):
-                            return 0.0
-                        val = str(value).strip()
-                        # Remove commas and currency symbols
-                        val = val.replace(',', '').replace('£', '').replace('$', '').strip()
-                        try:
-                            return float(val)
-                        except:
-                            return 0.0
-                    
-                    xero_df['_COST'] = xero_df[total_col].apply(parse_cost)
-                    
-                    # Filter out invalid TM numbers
-                    valid_mask = xero_df['_TM_NO'].apply(is_valid_tm_number)
-                    xero_df = xero_df[valid_mask].copy()
+                    xero_df = prepare_xero_report(xero_file.file_id, xero_bytes, inv_col, contact_col, total_col)
                     
                     st.success(f"✅ Xero Report mapped: Invoice={inv_col}, Contact={contact_col}, Total={total_col} ({len(xero_df)} rows)")
                 else:
@@ -480,294 +1067,40 @@ if tracker_file:
                 st.error(f"Error loading Xero Report: {str(e)}")
                 xero_df = None
         
-        # Run reconciliation
+        # The inputs run_reconciliation is cached on, which also key the cached exports
+        upload_ids = tuple(f.file_id if f else None for f in (tracker_file, tm_file, xero_file))
+        filters = (tuple(selected_months), tuple(selected_po_types), tuple(selected_statuses), tuple(selected_clients))
+        recon_key = (match_mode, upload_ids, filters, tuple(excluded_tps))
+        
+        # Run reconciliation, remembering what was run so the rerun from a download click keeps the results;
+        # changing the mode, files or filters afterwards waits for the next click instead of re-running
         if st.button("🔍 Run Reconciliation", type="primary"):
+            st.session_state['recon_key'] = recon_key
+            st.session_state['exports_ready'] = False
+        
+        if 'recon_key' in st.session_state and st.session_state['recon_key'] != recon_key:
+            st.info("Settings have changed since the last run - click Run Reconciliation to update the results.")
+        elif st.session_state.get('recon_key') == recon_key:
             try:
-                results = {
-                    'matched': [],
-                    'missing_in_tm': [],
-                    'missing_in_xero': [],
-                    'tp_mismatch_tm': [],
-                    'tp_mismatch_xero': [],
-                    'no_quote_in_tm': [],
-                    'cost_mismatch': []
-                }
-                
-                if match_mode == "Tracker vs TM":
-                    if tm_df is None:
-                        st.error("Please upload TM Report for this comparison")
-                        st.stop()
-                    
-                    for _, row in filtered_tracker.iterrows():
-                        try:
-                            tm_no = row['_TM_NO']
-                            tracker_tp = row['_TP_NAME']
-                            
-                            # Find all TM rows with this job number
-                            tm_matches = tm_df[tm_df['_TM_NO'] == tm_no]
-                            
-                            if tm_matches.empty:
-                                results['missing_in_tm'].append({
-                                    'TM NO': tm_no,
-                                    'Tracker TP': tracker_tp,
-                                    'Client': row.get(client_col, '') if client_col else '',
-                                    'PO Type': row.get(po_type_col, '') if po_type_col else '',
-                                    'Status': row.get(status_col, '') if status_col else '',
-                                    'FF Date': row.get(ff_date_col, '') if ff_date_col else ''
-                                })
-                            else:
-                                # Find the TM row where TP name matches tracker TP (fuzzy)
-                                matched_tm_row = None
-                                for _, tm_row in tm_matches.iterrows():
-                                    if fuzzy_match(tracker_tp, tm_row['_TP_NAME']):
-                                        matched_tm_row = tm_row
-                                        break
-                                
-                                if matched_tm_row is None:
-                                    # No TP match found among TM rows - list all TM TPs for reference
-                                    all_tm_tps = ', '.join(tm_matches['_TP_NAME'].dropna().unique().tolist())
-                                    results['tp_mismatch_tm'].append({
-                                        'TM NO': tm_no,
-                                        'Tracker TP': tracker_tp,
-                                        'TM TP(s)': all_tm_tps,
-                                        'TM Rows Found': len(tm_matches),
-                                        'Client': row.get(client_col, '') if client_col else '',
-                                        'Status': row.get(status_col, '') if status_col else ''
-                                    })
-                                else:
-                                    tm_tp = matched_tm_row['_TP_NAME']
-                                    tm_cost = matched_tm_row['_COST']
-                                    
-                                    if tm_cost == 0 or pd.isna(tm_cost):
-                                        results['no_quote_in_tm'].append({
-                                            'TM NO': tm_no,
-                                            'Tracker TP': tracker_tp,
-                                            'TM TP': tm_tp,
-                                            'TM Cost': tm_cost,
-                                            'Client': row.get(client_col, '') if client_col else '',
-                                            'Status': row.get(status_col, '') if status_col else '',
-                                            'FF Inspection Date': row.get(ff_date_col, '') if ff_date_col else ''
-                                        })
-                                    else:
-                                        results['matched'].append({
-                                            'TM NO': tm_no,
-                                            'TP': tracker_tp,
-                                            'TM Cost': tm_cost
-                                        })
-                        except Exception as e:
-                            st.warning(f"Error processing row {tm_no}: {str(e)}")
-                            continue
+                if match_mode == "Tracker vs TM" and tm_df is None:
+                    st.error("Please upload TM Report for this comparison")
+                    st.stop()
+                elif match_mode == "TM vs Xero" and (tm_df is None or xero_df is None):
+                    st.error("Please upload both TM Report and Xero Report for this comparison")
+                    st.stop()
+                elif match_mode == "3-way Full" and (tm_df is None or xero_df is None):
+                    st.error("Please upload both TM Report and Xero Report for 3-way comparison")
+                    st.stop()
                 
-                elif match_mode == "TM vs Xero":
-                    if tm_df is None or xero_df is None:
-                        st.error("Please upload both TM Report and Xero Report for this comparison")
-                        st.stop()
-                    
-                    # Filter TM by excluded TPs
-                    filtered_tm = tm_df[~tm_df['_TP_NAME'].isin(excluded_tps)].copy() if excluded_tps else tm_df.copy()
-                    
-                    # Process unique TM NO + TP combinations
-                    processed_combinations = set()
-                    
-                    for _, row in filtered_tm.iterrows():
-                        try:
-                            tm_no = row['_TM_NO']
-                            tm_tp = row['_TP_NAME']
-                            tm_cost = row['_COST']
-                            
-                            # Skip if we've already processed this TM NO + TP combination
-                            combo_key = (tm_no, str(tm_tp).lower().strip() if pd.notna(tm_tp) else '')
-                            if combo_key in processed_combinations:
-                                continue
-                            processed_combinations.add(combo_key)
-                            
-                            # Find all Xero rows with this job number
-                            xero_matches = xero_df[xero_df['_TM_NO'] == tm_no]
-                            
-                            if xero_matches.empty:
-                                # Look up FF Inspection Date from tracker if available
-                                ff_date = ''
-                                if ff_date_col:
-                                    tracker_match = filtered_tracker[filtered_tracker['_TM_NO'] == tm_no]
-                                    if not tracker_match.empty:
-                                        ff_date = tracker_match.iloc[0].get(ff_date_col, '')
-                                
-                                # Get address from TM row
-                                tm_address = row.get('_ADDRESS', '') if '_ADDRESS' in row.index else ''
-                                
-                                results['missing_in_xero'].append({
-                                    'TM NO': tm_no,
-                                    'TM TP': tm_tp,
-                                    'TM Cost': tm_cost,
-                                    'Full Address': tm_address,
-                                    'FF Inspection Date': ff_date
-                                })
-                            else:
-                                # Find Xero row where TP matches
-                                matched_xero_row = None
-                                for _, xero_row in xero_matches.iterrows():
-                                    if fuzzy_match(tm_tp, xero_row['_TP_NAME']):
-                                        matched_xero_row = xero_row
-                                        break
-                                
-                                if matched_xero_row is None:
-                                    all_xero_tps = ', '.join(xero_matches['_TP_NAME'].dropna().unique().tolist())
-                                    results['tp_mismatch_xero'].append({
-                                        'TM NO': tm_no,
-                                        'TM TP': tm_tp,
-                                        'Xero TP(s)': all_xero_tps,
-                                        'TM Cost': tm_cost,
-                                        'Xero Rows Found': len(xero_matches)
-                                    })
-                                else:
-                                    xero_tp = matched_xero_row['_TP_NAME']
-                                    xero_cost = matched_xero_row['_COST']
-                                    
-                                    if not cost_matches(tm_cost, xero_cost):
-                                        diff = abs(float(tm_cost) - float(xero_cost))
-                                        max_cost = max(float(tm_cost), float(xero_cost))
-                                        diff_pct = (diff / max_cost * 100) if max_cost > 0 else 0
-                                        results['cost_mismatch'].append({
-                                            'TM NO': tm_no,
-                                            'TP': tm_tp,
-                                            'TM Cost': tm_cost,
-                                            'Xero Total': xero_cost,
-                                            'Difference': diff,
-                                            'Diff %': f"{diff_pct:.1f}%"
-                                        })
-                                    else:
-                                        results['matched'].append({
-                                            'TM NO': tm_no,
-                                            'TP': tm_tp,
-                                            'Cost': tm_cost
-                                        })
-                        except Exception as e:
-                            st.warning(f"Error processing TM row {tm_no}: {str(e)}")
-                            continue
-                
-                elif match_mode == "3-way Full":
-                    if tm_df is None or xero_df is None:
-                        st.error("Please upload both TM Report and Xero Report for 3-way comparison")
-                        st.stop()
-                    
-                    for _, row in filtered_tracker.iterrows():
-                        try:
-                            tm_no = row['_TM_NO']
-                            tracker_tp = row['_TP_NAME']
-                            
-                            # Find all TM rows with this job number
-                            tm_matches = tm_df[tm_df['_TM_NO'] == tm_no]
-                            
-                            if tm_matches.empty:
-                                results['missing_in_tm'].append({
-                                    'TM NO': tm_no,
-                                    'Tracker TP': tracker_tp,
-                                    'Client': row.get(client_col, '') if client_col else '',
-                                    'Status': row.get(status_col, '') if status_col else ''
-                                })
-                                continue
-                            
-                            # Find the TM row where TP name matches tracker TP (fuzzy)
-                            matched_tm_row = None
-                            for _, tm_row in tm_matches.iterrows():
-                                if fuzzy_match(tracker_tp, tm_row['_TP_NAME']):
-                                    matched_tm_row = tm_row
-                                    break
-                            
-                            if matched_tm_row is None:
-                                # No TP match found among TM rows
-                                all_tm_tps = ', '.join(tm_matches['_TP_NAME'].dropna().unique().tolist())
-                                results['tp_mismatch_tm'].append({
-                                    'TM NO': tm_no,
-                                    'Tracker TP': tracker_tp,
-                                    'TM TP(s)': all_tm_tps,
-                                    'TM Rows Found': len(tm_matches),
-                                    'Client': row.get(client_col, '') if client_col else ''
-                                })
-                                continue
-                            
-                            tm_tp = matched_tm_row['_TP_NAME']
-                            tm_cost = matched_tm_row['_COST']
-                            
-                            if tm_cost == 0 or pd.isna(tm_cost):
-                                results['no_quote_in_tm'].append({
-                                    'TM NO': tm_no,
-                                    'Tracker TP': tracker_tp,
-                                    'TM TP': tm_tp,
-                                    'Client': row.get(client_col, '') if client_col else '',
-                                    'FF Inspection Date': row.get(ff_date_col, '') if ff_date_col else ''
-                                })
-                                continue
-                            
-                            # Find in Xero - also match by TP name
-                            xero_matches = xero_df[xero_df['_TM_NO'] == tm_no]
-                            
-                            if xero_matches.empty:
-                                # Get address from matched TM row
-                                tm_address = matched_tm_row.get('_ADDRESS', '') if '_ADDRESS' in matched_tm_row.index else ''
-                                
-                                results['missing_in_xero'].append({
-                                    'TM NO': tm_no,
-                                    'TP': tracker_tp,
-                                    'TM Cost': tm_cost,
-                                    'Full Address': tm_address,
-                                    'Client': row.get(client_col, '') if client_col else '',
-                                    'FF Inspection Date': row.get(ff_date_col, '') if ff_date_col else ''
-                                })
-                                continue
-                            
-                            # Find the Xero row where TP name matches TM TP (fuzzy)
-                            matched_xero_row = None
-                            for _, xero_row in xero_matches.iterrows():
-                                if fuzzy_match(tm_tp, xero_row['_TP_NAME']):
-                                    matched_xero_row = xero_row
-                                    break
-                            
-                            if matched_xero_row is None:
-                                all_xero_tps = ', '.join(xero_matches['_TP_NAME'].dropna().unique().tolist())
-                                results['tp_mismatch_xero'].append({
-                                    'TM NO': tm_no,
-                                    'TM TP': tm_tp,
-                                    'Xero TP(s)': all_xero_tps,
-                                    'TM Cost': tm_cost,
-                                    'Xero Rows Found': len(xero_matches)
-                                })
-                            else:
-                                xero_tp = matched_xero_row['_TP_NAME']
-                                xero_cost = matched_xero_row['_COST']
-                                
-                                if not cost_matches(tm_cost, xero_cost):
-                                    diff = abs(float(tm_cost) - float(xero_cost))
-                                    max_cost = max(float(tm_cost), float(xero_cost))
-                                    diff_pct = (diff / max_cost * 100) if max_cost > 0 else 0
-                                    results['cost_mismatch'].append({
-                                        'TM NO': tm_no,
-                                        'TP': tracker_tp,
-                                        'TM Cost': tm_cost,
-                                        'Xero Total': xero_cost,
-                                        'Difference': diff,
-                                        'Diff %': f"{diff_pct:.1f}%"
-                                    })
-                                else:
-                                    results['matched'].append({
-                                        'TM NO': tm_no,
-                                        'TP': tracker_tp,
-                                        'Cost': tm_cost
-                                    })
-                        except Exception as e:
-                            st.warning(f"Error processing 3-way row {tm_no}: {str(e)}")
-                            continue
+                results = run_reconciliation(
+                    match_mode, upload_ids, filters, filtered_tracker, tm_df, xero_df, excluded_tps,
+                    ff_date_col, po_type_col, status_col, client_col
+                )
                 
-                # Calculate summary
+                # Calculate summary; one pass over the categories gives both the breakdown and the total
+                mismatch_summary = {label: len(results[key]) for key, label, _, _ in DRILL_DOWNS if not results[key].empty}
                 total_matched = len(results['matched'])
-                total_mismatches = (
-                    len(results['missing_in_tm']) +
-                    len(results['missing_in_xero']) +
-                    len(results['tp_mismatch_tm']) +
-                    len(results['tp_mismatch_xero']) +
-                    len(results['no_quote_in_tm']) +
-                    len(results['cost_mismatch'])
-                )
+                total_mismatches = sum(mismatch_summary.values())
                 total_jobs = total_matched + total_mismatches
                 match_pct = (total_matched / total_jobs * 100) if total_jobs > 0 else 0
                 
@@ -781,20 +1114,6 @@ if tracker_file:
                 # Mismatch breakdown
                 st.header("🔎 Mismatch Breakdown")
                 
-                mismatch_summary = {}
-                if results['missing_in_tm']:
-                    mismatch_summary['Missing in TM'] = len(results['missing_in_tm'])
-                if results['missing_in_xero']:
-                    mismatch_summary['Missing in Xero'] = len(results['missing_in_xero'])
-                if results['tp_mismatch_tm']:
-                    mismatch_summary['TP Mismatch (Tracker vs TM)'] = len(results['tp_mismatch_tm'])
-                if results['tp_mismatch_xero']:
-                    mismatch_summary['TP Mismatch (TM vs Xero)'] = len(results['tp_mismatch_xero'])
-                if results['no_quote_in_tm']:
-                    mismatch_summary['No Quote in TM (Cost=0)'] = len(results['no_quote_in_tm'])
-                if results['cost_mismatch']:
-                    mismatch_summary['Cost Mismatch (>1%)'] = len(results['cost_mismatch'])
-                
                 if mismatch_summary:
                     num_cols = min(len(mismatch_summary), 6)
                     cols = st.columns(num_cols)
@@ -806,191 +1125,44 @@ if tracker_file:
                 # Drill-down tables
                 st.header("📋 Drill-Down Details")
                 
-                if results['missing_in_tm']:
-                    with st.expander(f"❌ Missing in TM ({len(results['missing_in_tm'])})"):
-                        df = pd.DataFrame(results['missing_in_tm'])
-                        st.dataframe(df, use_container_width=True)
-                        excel_data = to_excel(df)
-                        if excel_data:
-                            st.download_button("📥 Download", excel_data, "missing_in_tm.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_missing_tm")
-                
-                if results['missing_in_xero']:
-                    with st.expander(f"❌ Missing in Xero ({len(results['missing_in_xero'])})"):
-                        df = pd.DataFrame(results['missing_in_xero'])
-                        st.dataframe(df, use_container_width=True)
+                for key, _, title, button_key in DRILL_DOWNS:
+                    df = results[key]
+                    if df.empty:
+                        continue
+                    with st.expander(f"{title} ({len(df)})"):
+                        # Only the first PREVIEW_ROWS rows go to the browser unless asked; downloads stay complete
+                        show_all = len(df) <= PREVIEW_ROWS or st.checkbox(f"Show all {len(df)} rows", key=f"full_{key}")
+                        st.dataframe(df if show_all else df.head(PREVIEW_ROWS), use_container_width=True)
+                        if key != 'missing_in_xero':
+                            download_buttons(recon_key, df, key, button_key)
+                            continue
                         
                         col1, col2 = st.columns(2)
                         with col1:
-                            excel_data = to_excel(df)
-                            if excel_data:
-                                st.download_button("📥 Download Excel", excel_data, "missing_in_xero.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_missing_xero")
+                            download_buttons(recon_key, df, key, button_key)
                         
                         with col2:
                             # Create Xero Bill Template CSV
-                            from datetime import datetime, timedelta
-                            
-                            def clean_tp_name_for_xero(name):
-                                """Remove DC/TCR prefixes and clean up TP name for Xero"""
-                                if pd.isna(name) or not name:
-                                    return ''
-                                name = str(name).strip()
-                                # Remove common prefixes - order matters! Longest first
-                                prefixes_to_remove = ['DC & TCR ', 'DC &TCR ', 'DC TCR ', 'TCR ', 'DC ']
-                                for prefix in prefixes_to_remove:
-                                    if name.upper().startswith(prefix.upper()):
-                                        name = name[len(prefix):].strip()
-                                        break  # Only remove one prefix
-                                return name
-                            
-                            def format_date_for_xero(date_val):
-                                """Format date as dd/MM/YYYY for Xero"""
-                                if pd.isna(date_val) or date_val == '':
-                                    return ''
-                                try:
-                                    if isinstance(date_val, datetime):
-                                        return date_val.strftime('%d/%m/%Y')
-                                    elif isinstance(date_val, str):
-                                        # Try to parse common formats
-                                        for fmt in ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%Y/%m/%d']:
-                                            try:
-                                                dt = datetime.strptime(date_val.split(' ')[0], fmt)
-                                                return dt.strftime('%d/%m/%Y')
-                                            except:
-                                                continue
-                                        return date_val  # Return as-is if can't parse
-                                    else:
-                                        return str(date_val)
-                                except:
-                                    return ''
-                            
-                            def calculate_due_date(invoice_date_str):
-                                """Calculate due date as invoice date + 30 days"""
-                                if not invoice_date_str:
-                                    return ''
-                                try:
-                                    dt = datetime.strptime(invoice_date_str, '%d/%m/%Y')
-                                    due_dt = dt + timedelta(days=30)
-                                    return due_dt.strftime('%d/%m/%Y')
-                                except:
-                                    return ''
-                            
-                            xero_template = []
-                            for item in results['missing_in_xero']:
-                                tm_no = item.get('TM NO', '')
-                                # Remove TM prefix for Xero
-                                inv_no = tm_no.replace('TM', '') if tm_no else ''
-                                tp_name = item.get('TM TP', item.get('TP', ''))
-                                tp_name_clean = clean_tp_name_for_xero(tp_name)
-                                cost = item.get('TM Cost', 0)
-                                address = item.get('Full Address', '')
-                                
-                                # Get FF Inspection Date and format it
-                                ff_date = item.get('FF Inspection Date', '')
-                                invoice_date_str = format_date_for_xero(ff_date)
-                                due_date_str = calculate_due_date(invoice_date_str)
-                                
-                                # Add data row
-                                xero_template.append({
-                                    'ContactName': tp_name_clean,
-                                    'InvoiceNumber': inv_no,
-                                    'InvoiceDate': invoice_date_str,
-                                    'DueDate': due_date_str,
-                                    'Total': cost,
-                                    'Description': address,
-                                    'Quantity': 1,
-                                    'UnitAmount': cost,
-                                    'AccountCode': '5-0820',
-                                    'TaxType': '20% (VAT on Expenses)',
-                                    'TaxAmount': ''
-                                })
-                                # Add blank row after each entry
-                                xero_template.append({
-                                    'ContactName': '',
-                                    'InvoiceNumber': '',
-                                    'InvoiceDate': '',
-                                    'DueDate': '',
-                                    'Total': '',
-                                    'Description': '',
-                                    'Quantity': '',
-                                    'UnitAmount': '',
-                                    'AccountCode': '',
-                                    'TaxType': '',
-                                    'TaxAmount': ''
-                                })
-                            
-                            if xero_template:
-                                xero_df = pd.DataFrame(xero_template)
-                                csv_data = xero_df.to_csv(index=False)
+                            xero_template = xero_bill_template(df)
+                            if not xero_template.empty:
                                 st.download_button(
                                     "📥 Download Xero Template (CSV)",
-                                    csv_data,
+                                    lambda df=xero_template: df.to_csv(index=False),
                                     "xero_bill_import.csv",
                                     "text/csv",
                                     key="dl_xero_template"
                                 )
                 
-                if results['tp_mismatch_tm']:
-                    with st.expander(f"⚠️ TP Mismatch - Tracker vs TM ({len(results['tp_mismatch_tm'])})"):
-                        df = pd.DataFrame(results['tp_mismatch_tm'])
-                        st.dataframe(df, use_container_width=True)
-                        excel_data = to_excel(df)
-                        if excel_data:
-                            st.download_button("📥 Download", excel_data, "tp_mismatch_tm.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_tp_tm")
-                
-                if results['tp_mismatch_xero']:
-                    with st.expander(f"⚠️ TP Mismatch - TM vs Xero ({len(results['tp_mismatch_xero'])})"):
-                        df = pd.DataFrame(results['tp_mismatch_xero'])
-                        st.dataframe(df, use_container_width=True)
-                        excel_data = to_excel(df)
-                        if excel_data:
-                            st.download_button("📥 Download", excel_data, "tp_mismatch_xero.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_tp_xero")
-                
-                if results['no_quote_in_tm']:
-                    with st.expander(f"💰 No Quote in TM - Cost=0 ({len(results['no_quote_in_tm'])})"):
-                        df = pd.DataFrame(results['no_quote_in_tm'])
-                        st.dataframe(df, use_container_width=True)
-                        excel_data = to_excel(df)
-                        if excel_data:
-                            st.download_button("📥 Download", excel_data, "no_quote_in_tm.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_no_quote")
-                
-                if results['cost_mismatch']:
-                    with st.expander(f"💸 Cost Mismatch >1% ({len(results['cost_mismatch'])})"):
-                        df = pd.DataFrame(results['cost_mismatch'])
-                        st.dataframe(df, use_container_width=True)
-                        excel_data = to_excel(df)
-                        if excel_data:
-                            st.download_button("📥 Download", excel_data, "cost_mismatch.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_cost")
-                
                 # Full export
-                st.header("📥 Export All Mismatches")
-                all_mismatches = []
-                for key, items in results.items():
-                    if key != 'matched' and items:
-                        for item in items:
-                            item_copy = item.copy()
-                            item_copy['Mismatch Type'] = key.replace('_', ' ').title()
-                            all_mismatches.append(item_copy)
-                
-                if all_mismatches:
-                    all_df = pd.DataFrame(all_mismatches)
-                    excel_data = to_excel(all_df)
-                    if excel_data:
-                        st.download_button(
-                            "📥 Download All Mismatches (Excel)",
-                            excel_data,
-                            "all_mismatches.xlsx",
-                            "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                            type="primary",
-                            key="dl_all"
-                        )
+                export_section(recon_key, results, total_mismatches)
             
             except Exception as e:
                 st.error(f"Error during reconciliation: {str(e)}")
-                st.code(traceback.format_exc())
+                st.code(traceback.format_exc(limit=-TRACEBACK_FRAMES))
     
     except Exception as e:
         st.error(f"Error loading Tracker file: {str(e)}")
-        st.code(traceback.format_exc())
+        st.code(traceback.format_exc(limit=-TRACEBACK_FRAMES))
 
 else:
     st.info("👈 Please upload the Job Tracker file to begin")